@@ -1,13 +1,14 @@
-import time
 from socket import * 
 import threading 
+import itertools
 import logging 
+import sys
+from array import array
 from p2p_meetings.message_types import * 
 from p2p_meetings.constants import * 
 from p2p_meetings.socket_util import * 
 
 
-
 class MeetingEntry:
     """
     Keep track of host (addr, port) 
@@ -17,42 +18,270 @@ class MeetingEntry:
     meeting, no future peer can use this username in the same meeting,
     even if the original peer with that username leaves. 
     """
-    def __init__(self, client_socket, addr_port):
+    # fixed attribute layout (no per-instance __dict__), since 
+    # the server may keep many of these around
+    __slots__ = ("client_socket", "host_addr_port", "usernames", 
+                 "meetingType", "meeting_ports")
+
+    def __init__(self, client_socket:socket, addr_port:tuple, meetingType:str):
         self.client_socket = client_socket
+        # let the kernel detect hosts that vanish without 
+        # closing the connection
+        enable_keepalive(client_socket)
 
         self.host_addr_port = addr_port
-        self.host_addr, self.host_port = addr_port 
 
-        # keep track of usernames registered within a meeting 
-        self.usernames = set()
-        self.usernames.add(HOST_USERNAME)
+        # keep track of usernames registered within a meeting,
+        # starting with the reserved ones so a single lookup 
+        # checks both 
+        self.usernames = set(RESERVED_USERNAMES)
+
+        # STAR or MESH, decides how join requests are answered
+        self.meetingType = meetingType
 
         # set of ports used in this p2p network
         self.meeting_ports = set()
 
-    def add_port(self, port):
+    @property
+    def host_addr(self):
+        return self.host_addr_port[0]
+
+    @property
+    def host_port(self):
+        return self.host_addr_port[1]
+
+    def add_port(self, port:int) -> None:
         self.meeting_ports.add(port)
 
-    def has_username(self, name):
+    def has_username(self, name:str) -> bool:
         return name in self.usernames
 
-    def add_username(self, name):
-        self.usernames.add(name)
+    def add_username(self, name:str) -> None:
+        # names decoded from requests are new string objects;
+        # interning lets repeated names share one copy 
+        self.usernames.add(sys.intern(name))
 
-# StarMeetingEntry and MeshMeetingEntry 
-# have the exact same behavior, but they 
-# are handled differently when 
-# creating a response, so these classes
-# just provide a tag for which kind of meeting is being recorded. 
-class StarMeetingEntry(MeetingEntry):
-    def __init__(self, client_socket, addr_port):
-        super().__init__(client_socket, addr_port)
-        self.meetingType = STAR
+# response to a successful join for each type of meeting, 
+# and whether the joining peer needs its own p2p port
+# (mesh peers accept connections from later peers)
+JOIN_SUCCESS_RESPONSES = {
+    STAR : (JoinStarSuccess, False),
+    MESH : (JoinMeshSuccess, True),
+}
 
-class MeshMeetingEntry(MeetingEntry):
-    def __init__(self, client_socket, addr_port):
-        super().__init__(client_socket, addr_port)
-        self.meetingType = MESH
+# response to a successful create for each type of meeting
+CREATE_SUCCESS_RESPONSES = {
+    STAR : CreateStarSuccess,
+    MESH : CreateMeshSuccess,
+}
+
+
+#######################################################
+
+# meeting types are stored as one byte each in MeetingListing
+MEETING_TYPE_CODES = { STAR : 0, MESH : 1 }
+MEETING_TYPE_NAMES = [ STAR, MESH ]
+
+class MeetingListing:
+    """
+    Columnar copy of the (meetingID, meetingType) pairs 
+    needed to answer LIST requests. 
+
+    IDs, types, and alive flags are kept in three dense arrays,
+    so building a listing is a sequential scan instead of 
+    visiting every MeetingEntry object. Deleted meetings are only 
+    flagged as dead; the arrays are compacted once more than
+    half of the rows are dead. 
+
+    The encoded LIST response is cached until the next 
+    add or remove, since clients usually list far more 
+    often than meetings are created or deleted. 
+    """
+    def __init__(self):
+        self.ids = array("q")
+        self.types = bytearray()
+        self.alive = bytearray()
+
+        # meetingID -> row in the arrays above
+        self._rows = {}
+        self._num_dead = 0
+        self._lock = threading.Lock()
+
+        # encoded ListResponse, or None if it must be rebuilt
+        self._encoded_response = None
+
+    def add(self, meetingID, meetingType):
+        with self._lock:
+            self._encoded_response = None
+            self._rows[meetingID] = len(self.ids)
+            self.ids.append(meetingID)
+            self.types.append(MEETING_TYPE_CODES[meetingType])
+            self.alive.append(1)
+
+    def remove(self, meetingID):
+        with self._lock:
+            row = self._rows.pop(meetingID, None)
+            if row is None:
+                return
+
+            self._encoded_response = None
+            self.alive[row] = 0
+            self._num_dead += 1
+            if 2 * self._num_dead > len(self.ids):
+                self._compact()
+
+    def _compact(self):
+        """
+        Drop dead rows. Caller must hold self._lock.
+        """
+        live_rows = [row for row, is_alive in enumerate(self.alive) if is_alive]
+        self.ids = array("q", (self.ids[row] for row in live_rows))
+        self.types = bytearray(self.types[row] for row in live_rows)
+        self.alive = bytearray([1]) * len(live_rows)
+
+        self._rows = { meetingID : row for row, meetingID in enumerate(self.ids) }
+        self._num_dead = 0
+
+    def snapshot(self):
+        """
+        List of (meetingID, meetingType) for every live meeting. 
+        """
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        """
+        Build snapshot. Caller must hold self._lock.
+        """
+        live = itertools.compress(zip(self.ids, self.types), self.alive)
+        return [(meetingID, MEETING_TYPE_NAMES[code]) for meetingID, code in live]
+
+    def encoded_response(self) -> bytes:
+        """
+        Encoded ListResponse for the current listing, 
+        ready to send to a client. 
+        """
+        with self._lock:
+            if self._encoded_response is None:
+                self._encoded_response = ListResponse(self._snapshot()).encode()
+            return self._encoded_response
+
+
+#######################################################
+
+class ShardedDict:
+    """
+    Dictionary split into n shards, each guarded by its 
+    own lock. A key lives in shard hash(key) % n, so threads 
+    working on different keys rarely wait on each other. 
+
+    Iteration (keys/items) returns a snapshot, built by 
+    locking one shard at a time, so it is safe while other 
+    threads add or remove entries. 
+    """
+    def __init__(self, n=16):
+        self.shards = [{} for _ in range(n)]
+        self.locks = [threading.Lock() for _ in range(n)]
+
+    def _shard_index(self, key):
+        return hash(key) % len(self.shards)
+
+    def get(self, key, default=None):
+        i = self._shard_index(key)
+        with self.locks[i]:
+            return self.shards[i].get(key, default)
+
+    def put(self, key, value):
+        i = self._shard_index(key)
+        with self.locks[i]:
+            self.shards[i][key] = value
+
+    def pop(self, key, default=None):
+        i = self._shard_index(key)
+        with self.locks[i]:
+            return self.shards[i].pop(key, default)
+
+    def items(self):
+        """
+        Snapshot of (key, value) pairs. Never holds 
+        more than one shard lock at a time. 
+        """
+        snapshot = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                snapshot.extend(shard.items())
+        return snapshot
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def __getitem__(self, key):
+        i = self._shard_index(key)
+        with self.locks[i]:
+            return self.shards[i][key]
+
+    def __contains__(self, key):
+        i = self._shard_index(key)
+        with self.locks[i]:
+            return key in self.shards[i]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+
+class _ClientContext:
+    """
+    Per-connection state for a client of the central server.
+
+    The bound methods of this object are used as the reactor 
+    and message callbacks for the connection, so no closures 
+    over the socket need to be allocated per connection. 
+    Each read still makes a bound on_request and a view 
+    of the received bytes, both short-lived. 
+    """
+    __slots__ = ("server", "reactor", "client_socket", "addr_port", "message_buffer")
+
+    def __init__(self, server, reactor, client_socket, addr_port):
+        self.server = server
+        # reactor watching client_socket
+        self.reactor = reactor
+        self.client_socket = client_socket
+        self.addr_port = addr_port
+        # holds a partially received request between reads
+        self.message_buffer = MessageBuffer()
+
+    def read_requests(self):
+        """
+        Receive available bytes from the client and handle
+        each complete request. If the client closed the 
+        connection, stop watching its socket. The socket is 
+        non-blocking, so this returns right away if nothing 
+        has arrived yet. 
+        """
+        recv_buffer = self.reactor.recv_buffer
+        nbytes = 0
+        try:
+            nbytes = self.client_socket.recv_into(recv_buffer)
+        except BlockingIOError:
+            # nothing to read yet 
+            return
+        except Exception as e:
+            logging.error("Exception raised while listening to socket: %s", str(e))
+
+        if not nbytes:
+            self.on_close()
+            return
+
+        message_bytes = self.message_buffer.feed(recv_buffer[:nbytes])
+        if message_bytes:
+            dispatch_messages(message_bytes, MeetingRequest, self.on_request)
+
+    def on_request(self, mtng_request):
+        self.server.handle_request(mtng_request, self.client_socket, self.addr_port)
+
+    def on_close(self):
+        self.reactor.unregister(self.client_socket)
+        self.server.remove_client(self.client_socket, self.addr_port)
 
 
 #######################################################
@@ -73,19 +302,32 @@ class Server:
     def __init__(self):
         # map meetingID to MeetingEntry
         # objects 
-        self.meetings = {} 
+        self.meetings = ShardedDict()
 
-        self._unique_meetingID = 0
-        self._unique_meetingID_lock = threading.Lock()
+        # map host client socket to the IDs of the meetings 
+        # it created, so they can be found without a scan 
+        # when it disconnects. a socket is only ever touched by 
+        # the reactor thread, so no lock is needed 
+        self.hosted_meetings = {}
 
-        self._unique_meeting_port = DEFAULT_P2P_PORT
-        self._unique_meeting_port_lock = threading.Lock()
+        # meeting IDs and types in a LIST-friendly layout
+        self.listing = MeetingListing()
 
-        # flag to keep looping in self.wait_for_connections 
-        self.keep_accepting_connections = True
+        # next() on itertools.count is atomic under the GIL,
+        # so no lock is needed to hand out unique values
+        self._unique_meetingID = itertools.count()
+        self._unique_meeting_port = itertools.count(DEFAULT_P2P_PORT)
 
-        # keep list of client sockets so they can be closed
-        self.client_sockets = [] 
+        # map client sockets to their _ClientContext (holding the 
+        # peer (addr, port), saved at accept time), so they can be 
+        # written, closed and logged later without calling 
+        # getpeername. sockets are removed as soon as their 
+        # client disconnects
+        self.client_sockets = {}
+
+        # a single reactor thread multiplexes the listening 
+        # socket and every client socket (no thread per client)
+        self.reactor = Reactor()
 
         self.connection_socket = None
         self.connection_thread = \
@@ -99,187 +341,183 @@ class Server:
 
         Also close all client sockets. 
         """
-        self.keep_accepting_connections = False
-        # self.connection_thread.join()
+        self.reactor.stop()
 
         if self.connection_socket:
             # shutdown and close socket
             safe_shutdown_close(self.connection_socket)
 
-        for sock in self.client_sockets:
-            peer_name= "closed"
-            try:
-                peer_name = sock.getpeername()
-            except:
-                pass
-            logging.info("server: close sock %s", peer_name)
+        # copy, since the reactor may still be removing sockets
+        for sock, client in list(self.client_sockets.items()):
+            # already closed (fileno is -1), nothing to do
+            if sock.fileno() == -1:
+                continue
+            logging.info("server: close sock %s", client.addr_port)
             safe_shutdown_close(sock)
 
-    def new_meetingID(self):
+    def new_meetingID(self) -> int:
         """
         Assign new meeting ID and increment global counter. 
-        Synchronized to avoid multiple threads assigning the 
-        same meeting ID. 
+        Safe to call from multiple threads without 
+        assigning the same meeting ID twice. 
         """
-        uid = 0
-        with self._unique_meetingID_lock:
-            uid = self._unique_meetingID
-            self._unique_meetingID += 1
-        return uid
+        return next(self._unique_meetingID)
 
-    def new_meeting_port(self):
+    def new_meeting_port(self) -> int:
         """
         Assign new meeting port and increment global counter. 
-        Synchronized to avoid multiple threads assigning the 
-        same meeting port. 
+        Safe to call from multiple threads without 
+        assigning the same meeting port twice. 
         """
-        port = 0
-        with self._unique_meeting_port_lock:
-            port = self._unique_meeting_port
-            self._unique_meeting_port += 1
-        return port
+        return next(self._unique_meeting_port)
 
     def wait_for_connections(self):
         """
-        Loop forever and wait for 
-        new clients to make tcp connection 
-        requests. 
-        
-        Once a client connects, they
-        can make some requests (in a new thread)
-        and then eventually disconnect. 
+        Open the listening socket and run the reactor 
+        loop in this thread. 
+
+        New connections and requests from connected clients
+        are all handled by the reactor as the sockets become 
+        readable, so many clients can be served at once 
+        without a thread per client. 
         """
+        connection_socket = make_socket()
+        tune_socket(connection_socket)
+        connection_socket.bind(('', SERVER_PORT))
+        connection_socket.listen(LISTEN_BACKLOG)
+        connection_socket.setblocking(False)
+        self.connection_socket = connection_socket
 
-        self.connection_socket = make_socket()
-        self.connection_socket.bind(('', SERVER_PORT))
-        self.connection_socket.listen()
-
-        while self.keep_accepting_connections:
-            try: # socket may be closed after loop is entered 
-                try:
-                    client_socket, addr_port = self.connection_socket.accept()
-                except timeout:
-                    continue
-                except Exception as e:
-                    logging.error("Error acceptin socket: %s", str(e))
-                    continue
-
-                info_str = "Central server: got a new connection from %s" % str(addr_port)
-                logging.info(info_str)
-
-                self.client_sockets.append(client_socket)
-
-                # listen for requests from this client in a separate thread
-                # so other clients can connect simultaneously
-                request_thread = self.make_request_thread(client_socket, addr_port)
-                request_thread.start()
-            except Exception as e:
-                logging.error(str(e))
+        self.reactor.register(self.connection_socket, self.accept_connection)
+        self.reactor.run()
 
-    def make_request_thread(self, client_socket, addr_port):
+    def accept_connection(self):
+        """
+        Called by the reactor when clients are waiting to connect. 
+        Accept every pending connection (not just one per wakeup)
+        and start watching the new sockets for requests. 
         """
-        Create a new ListenThread object to listen for 
-        requests from a client. 
+        while True:
+            try:
+                client_socket, addr_port = self.connection_socket.accept()
+            except BlockingIOError:
+                # accept queue drained 
+                return
+            except Exception as e:
+                logging.error("Error acceptin socket: %s", str(e))
+                return
 
-        Can't inline this above, or else binding issues arise
-        since client_socket and addr_port get reassigned every
-        iteration of the while loop. 
+            logging.info("Central server: got a new connection from %s", addr_port)
+
+            # not every platform lets accepted sockets 
+            # inherit options from the listening socket
+            tune_socket(client_socket)
+
+            # responses are sent from the reactor thread, so they 
+            # must never block on a client that stops reading
+            client_socket.setblocking(False)
+
+            client = _ClientContext(self, self.reactor, client_socket, addr_port)
+            self.client_sockets[client_socket] = client
+            self.reactor.register(client_socket, client.read_requests)
+
+            # clients usually send a request right after connecting,
+            # so try to read it now instead of waiting for 
+            # another wakeup from the reactor. the socket is 
+            # non-blocking, so this works on every platform 
+            # (MSG_DONTWAIT isn't available on Windows) 
+            client.read_requests()
+
+    def remove_client(self, client_socket, addr_port):
+        """
+        Clean up after a client once the connection 
+        is closed (or reported dead by keepalive). Any meetings
+        hosted by this client have ended, so delete them. 
         """
-        peer_name = client_socket.getpeername()
-        return ListenThread(MeetingRequest,   \
-                             client_socket, \
-                             lambda req: self.handle_request(req, client_socket, addr_port), \
-                             lambda: logging.info(f"Client {peer_name} closed connection."))
+        logging.info(f"Client {addr_port} closed connection.")
 
-    def send_response(self, response_obj, client_socket):
+        for meetingID in self.hosted_meetings.pop(client_socket, ()):
+            self.delete_meeting_entry(meetingID)
+
+        self.client_sockets.pop(client_socket, None)
+        safe_shutdown_close(client_socket)
+
+    def send_response(self, response_obj:ServerResponse, client_socket:socket, addr_port:tuple=None) -> None:
         """ 
         response_obj - ServerResponse object
+
+        addr_port - peer address of client_socket, if already known
         """
         if response_obj.is_valid():
-            logging.debug("Sending to client %s: %s", str(client_socket.getpeername()), str(response_obj))
-            safe_send(client_socket, response_obj.encode())
+            if addr_port is None and client_socket in self.client_sockets:
+                addr_port = self.client_sockets[client_socket].addr_port
+            logging.debug("Sending to client %s: %s", addr_port, response_obj)
+            self.send_bytes(client_socket, response_obj.encode())
         else:
             logging.error("Error: Cannot send invalid ServerResponse object: %s", 
                     str(response_obj))
 
-    def delete_meeting_entry(self, meetingID):
+    def send_bytes(self, client_socket:socket, data:bytes) -> None:
         """
-        Delete a MeetingEntry object in self.meetings
+        Send bytes to a client without blocking. Whatever the 
+        socket can't take right away is queued on the reactor, 
+        and a client that lets too much pile up 
+        is disconnected (see Reactor.send). 
         """
-        if meetingID in self.meetings:
-            safe_shutdown_close(self.meetings[meetingID].client_socket)
-            # safely delete dict key 
-            self.meetings.pop(meetingID, None)
+        client = self.client_sockets.get(client_socket)
+        if client is None:
+            # client already disconnected 
+            return
+        client.reactor.send(client_socket, [data])
 
-    def get_listing(self):
+    def delete_meeting_entry(self, meetingID:int) -> None:
         """
-        Go through list of meetings and return 
-        list of ongoing meetings (prune those that have ended).
+        Delete a MeetingEntry object in self.meetings
         """
-        meeting_list = []
-        to_delete = []
-        for meetingID in self.meetings: 
-            meeting_entry = self.meetings[meetingID]
-
-            # check if socket is still open by sending test data
-            try:
-                # sending one messages usually fails to raise exception 
-                # immediately, so send two
-                meeting_entry.client_socket.send(TEST_MESSAGE.encode())
-                # wait for a few milliseconds 
-                time.sleep(0.1)
-                meeting_entry.client_socket.send(TEST_MESSAGE.encode())
-            except:
-                to_delete.append(meetingID)
-                continue
-
-            meeting_list.append((meetingID, meeting_entry.meetingType))
+        # safely delete dict key 
+        meeting_entry = self.meetings.pop(meetingID)
+        if meeting_entry is not None:
+            self.listing.remove(meetingID)
+            safe_shutdown_close(meeting_entry.client_socket)
 
-        # delete entries after iterating 
-        for meetingID in to_delete:
-            self.delete_meeting_entry(meetingID)
-
-        return meeting_list
-
-    def handle_request(self, mtng_request, client_socket, addr_port):
+    def handle_request(self, mtng_request:MeetingRequest, client_socket:socket, addr_port:tuple) -> None:
         """ 
         mtng_request - MeetingRequest object
 
         addr_port - ip address and port for socket connection from client to server... 
         """
-        logging.debug("HANDLE REQUEST: %s", str(mtng_request))
+        logging.debug("HANDLE REQUEST: %s", mtng_request)
 
         # TODO use is_valid() and send error response if invalid 
 
         response = None
 
         if mtng_request.type == LIST:
-            # create new response with list of meeting ids
-            response = ListResponse(self.get_listing())
+            # the listing is only re-encoded after a meeting 
+            # is created or deleted, and is always valid
+            self.send_bytes(client_socket, self.listing.encoded_response())
+            return
 
         elif mtng_request.type == JOIN:
-            if mtng_request.data.meetingID in self.meetings:
-                meeting_entry = self.meetings[mtng_request.data.meetingID]
+            meeting_entry = self.meetings.get(mtng_request.data.meetingID)
+            if meeting_entry is not None:
 
                 # check if username is already taken 
                 requested_username = mtng_request.data.username 
-                if meeting_entry.has_username(requested_username) or \
-                    requested_username in [HOST_USERNAME, DEFAULT_USERNAME]:
-
+                if meeting_entry.has_username(requested_username):
                     response = JoinFailure("Username '%s' already taken. Please choose another." % requested_username)
                 else:
                     # add new username to record for this meeting 
                     meeting_entry.add_username(requested_username)
 
-                    if isinstance(meeting_entry, StarMeetingEntry):
-                        response = JoinStarSuccess(meeting_entry.host_addr_port, requested_username)
-                    elif isinstance(meeting_entry, MeshMeetingEntry):
+                    response_type, needs_port = JOIN_SUCCESS_RESPONSES[meeting_entry.meetingType]
+                    if needs_port:
                         # must assign unique port to new mesh peer
                         listen_p2p_port = self.new_meeting_port()
 
-                        response = JoinMeshSuccess(meeting_entry.host_addr_port, requested_username, listen_p2p_port)
+                        response = response_type(meeting_entry.host_addr_port, requested_username, listen_p2p_port)
                     else:
-                        response = JoinFailure("Meeting ID '%s' has wrong type." % mtng_request.data.meetingID)
+                        response = response_type(meeting_entry.host_addr_port, requested_username)
             else:
                 response = JoinFailure("Meeting ID '%s' not found." % mtng_request.data.meetingID)
 
@@ -287,27 +525,28 @@ class Server:
         # the host and the port that will be used to make connections
         # in the p2p meeting network 
         elif mtng_request.type == CREATE:
-            # generate unique meetingID
-            meetingID = self.new_meetingID()
+            meetingType = mtng_request.data.meetingType
+            response_type = CREATE_SUCCESS_RESPONSES.get(meetingType)
 
-            # determine port for p2p connections for this new meeting
-            # (must be unique to this meeting in case other peers 
-            # have the same IP addr)
-            p2p_port = self.new_meeting_port()
+            if response_type:
+                # generate unique meetingID
+                meetingID = self.new_meetingID()
 
-            # store address and p2p port so other users can join 
-            # this meeting in the future 
-            if mtng_request.data.meetingType == STAR:
-                response = CreateStarSuccess(meetingID, p2p_port)
-                self.meetings[meetingID] = StarMeetingEntry(client_socket, (addr_port[0], p2p_port))
+                # determine port for p2p connections for this new meeting
+                # (must be unique to this meeting in case other peers 
+                # have the same IP addr)
+                p2p_port = self.new_meeting_port()
 
-            if mtng_request.data.meetingType == MESH:
-                response = CreateMeshSuccess(meetingID, p2p_port)
-                self.meetings[meetingID] = MeshMeetingEntry(client_socket, (addr_port[0], p2p_port))
+                # store address and p2p port so other users can join 
+                # this meeting in the future 
+                response = response_type(meetingID, p2p_port)
+                self.meetings.put(meetingID, MeetingEntry(client_socket, (addr_port[0], p2p_port), meetingType))
+                self.listing.add(meetingID, meetingType)
+                self.hosted_meetings.setdefault(client_socket, []).append(meetingID)
 
         if response:
             # send response to requesting client 
-            self.send_response(response, client_socket)
+            self.send_response(response, client_socket, addr_port)
             return
 
         # ERROR case? no need to respond, but maybe log something on server 
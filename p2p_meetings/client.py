@@ -1,8 +1,11 @@
-from socket import *
-from p2p_meetings.message_types import * 
-from p2p_meetings.constants import * 
+from socket import socket, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY
+from p2p_meetings.message_types import LIST, JOIN, CREATE, STAR, MESH, ServerResponse, \
+        ListRequest, JoinRequest, CreateStarRequest, CreateMeshRequest
+from p2p_meetings.constants import SERVER_IP, SERVER_PORT, HOST_USERNAME
 import logging
-from p2p_meetings.p2p_nodes import *
+import threading
+from p2p_meetings.p2p_nodes import StarHostNode, StarAudienceNode, MeshHostNode, MeshAudienceNode
+from p2p_meetings.socket_util import ListenThread, safe_send, safe_shutdown_close, send_socket_message
 
 ######################################################
 ######################################################
@@ -16,16 +19,33 @@ from p2p_meetings.p2p_nodes import *
 ######################################################
                                                      
 
+# these requests never change, so encode them once 
+LIST_REQUEST_BYTES = ListRequest().encode()
+CREATE_STAR_BYTES = CreateStarRequest().encode()
+CREATE_MESH_BYTES = CreateMeshRequest().encode()
+
+
 class Client:
 
     def __init__(self):
-        # connect to central server
-        self.connect_with_server()
+        # handler for each type of server response.
+        # set before connecting, since responses 
+        # are handled as soon as they arrive 
+        self._handlers = {JOIN: self._on_join, 
+                          CREATE: self._on_create, 
+                          LIST: self._on_list}
 
         # this will be set when 
         # the client joins a p2p network 
         self.node = None
 
+        # thread creating the node for an accepted join,
+        # so shutdown can wait for it 
+        self._join_thread = None
+
+        # connect to central server
+        self.connect_with_server()
+
         # save messages from server for 
         # testing/debugging
         self.server_messages = []
@@ -33,16 +53,16 @@ class Client:
         self.meeting_response_data = [] 
     
     def star_create(self):
-        send_socket_message(self.client_socket, CreateStarRequest())
+        safe_send(self.client_socket, CREATE_STAR_BYTES)
 
     def mesh_create(self):
-        send_socket_message(self.client_socket, CreateMeshRequest())
+        safe_send(self.client_socket, CREATE_MESH_BYTES)
 
     def join(self, n, user_str):
         send_socket_message(self.client_socket, JoinRequest(n, user_str))
 
     def list(self):
-        send_socket_message(self.client_socket, ListRequest())
+        safe_send(self.client_socket, LIST_REQUEST_BYTES)
 
     def connect_with_server(self):
         """
@@ -50,6 +70,9 @@ class Client:
         and create new thread for listening for server responses.
         """
         self.client_socket = socket(AF_INET, SOCK_STREAM)
+        # requests are small and interactive, so send them 
+        # immediately instead of waiting for Nagle's algorithm 
+        self.client_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
 
         try:
             # try connecting to central server 
@@ -74,64 +97,86 @@ class Client:
         """
         Safely close socket with server and stop listening thread.
         """
-        safe_shutdown_close(self.client_socket)
-
+        # stop listening first, so the reactor never 
+        # touches the socket after it's closed 
         self.server_response_thread.stop()
 
+        safe_shutdown_close(self.client_socket)
+
     def handle_response(self, response_obj):
         """
         Handle response from server 
 
         response_obj - valid ServerResponse object
         """
-        if response_obj.type == JOIN:
-            # client attempts to join new p2p network 
-
-            if response_obj.success:
-                host_addr, host_port = response_obj.data.host
-                username = response_obj.data.username 
-
-                # Join a star-shaped meeting, so just connect
-                # with the host. 
-                if response_obj.data.meetingType == STAR:
-                    self.node = StarAudienceNode(username, host_addr, host_port)
-
-                # Join a full-mesh meeting, new tcp 
-                # connections will be created between the 
-                # joining user and all other nodes in the mesh network. 
-                elif response_obj.data.meetingType == MESH:
-                    # server should have assigned us a unique p2p port
-                    listen_p2p_port = response_obj.data.listen_p2p_port
-                    self.node = MeshAudienceNode(username, host_addr, host_port, listen_p2p_port)
-
-            else:
-                self.log_server_message("Join request failed: %s", str(response_obj.message))
-
-        # Create a new meeting. The underlying network initially 
-        # contains just the host node. As other users 
-        # request to join, a p2p network will be built up 
-        if response_obj.type == CREATE:
-            if response_obj.success:
-                listen_p2p_port = response_obj.data.listen_p2p_port
-
-                # create a meeting with star-shaped network topology
-                if response_obj.data.meetingType == STAR:
-                    self.node = StarHostNode(HOST_USERNAME, response_obj.data.meetingID, listen_p2p_port)
-
-                # create a meeting with full-mesh network topology
-                if response_obj.data.meetingType == MESH:
-                    self.node = MeshHostNode(HOST_USERNAME, response_obj.data.meetingID, listen_p2p_port)
-
-            else:
-                logging.info("Create request failed: %s", str(response_obj.message))
-
-        if response_obj.type == LIST:
-            if response_obj.success:
-                self.log_server_message("Available meetings (ID/type): %s", response_obj.data)
-                # save listing data for testing 
-                self.meeting_response_data.append(response_obj.data)
-            else:
-                logging.info("List request failed: %s", str(response_obj.message))
+        handler = self._handlers.get(response_obj.type)
+        if handler is not None:
+            handler(response_obj)
+
+    def _on_join(self, response_obj):
+        """
+        Client attempts to join new p2p network. 
+
+        Responses are handled on the reactor shared by every 
+        connection, and connecting to the host blocks, so the 
+        node is created in a separate thread. 
+        """
+        if response_obj.success:
+            join_thread = threading.Thread(target=self._join_meeting, args=(response_obj.data,))
+            join_thread.start()
+            # only once started, so shutdown can always join it
+            self._join_thread = join_thread
+        else:
+            self.log_server_message("Join request failed: %s", str(response_obj.message))
+
+    def _join_meeting(self, data):
+        """
+        Create the p2p node for a meeting the server 
+        accepted our join request for. 
+        """
+        host_addr, host_port = data.host
+        username = data.username 
+
+        # Join a star-shaped meeting, so just connect
+        # with the host. 
+        if data.meetingType == STAR:
+            self.node = StarAudienceNode(username, host_addr, host_port)
+
+        # Join a full-mesh meeting, new tcp 
+        # connections will be created between the 
+        # joining user and all other nodes in the mesh network. 
+        elif data.meetingType == MESH:
+            # server should have assigned us a unique p2p port
+            listen_p2p_port = data.listen_p2p_port
+            self.node = MeshAudienceNode(username, host_addr, host_port, listen_p2p_port)
+
+    def _on_create(self, response_obj):
+        """
+        Create a new meeting. The underlying network initially 
+        contains just the host node. As other users 
+        request to join, a p2p network will be built up 
+        """
+        if response_obj.success:
+            listen_p2p_port = response_obj.data.listen_p2p_port
+
+            # create a meeting with star-shaped network topology
+            if response_obj.data.meetingType == STAR:
+                self.node = StarHostNode(HOST_USERNAME, response_obj.data.meetingID, listen_p2p_port)
+
+            # create a meeting with full-mesh network topology
+            if response_obj.data.meetingType == MESH:
+                self.node = MeshHostNode(HOST_USERNAME, response_obj.data.meetingID, listen_p2p_port)
+
+        else:
+            logging.info("Create request failed: %s", str(response_obj.message))
+
+    def _on_list(self, response_obj):
+        if response_obj.success:
+            self.log_server_message("Available meetings (ID/type): %s", response_obj.data)
+            # save listing data for testing 
+            self.meeting_response_data.append(response_obj.data)
+        else:
+            logging.info("List request failed: %s", str(response_obj.message))
 
     def log_server_message(self, fmt_str:str, *args):
         """
@@ -151,7 +196,10 @@ class Client:
         server and with peers. Also stop listening thread"""
         self.disconnect_from_server()
 
-        self.server_response_thread.stop()
+        # let a pending join finish creating 
+        # its node, so the node is closed too 
+        if self._join_thread is not None:
+            self._join_thread.join()
 
         # close any p2p connections 
         if self.node:
@@ -1,8 +1,3 @@
-def nothing(*args, **kwargs):
-    pass
-
-print_to_server_log = nothing
-
 # AWS 
 # SERVER_IP = "3.132.213.19"
 
@@ -12,6 +7,9 @@ SERVER_IP = "localhost"
 DEFAULT_USERNAME = "default_user"
 HOST_USERNAME = "HOST"
 
+# usernames no peer may claim in any meeting
+RESERVED_USERNAMES = frozenset({HOST_USERNAME, DEFAULT_USERNAME})
+
 SERVER_PORT = 2000
 DEFAULT_P2P_PORT = 3100
 
@@ -24,9 +22,43 @@ BAD_WORDS = ["xxx", "yyy", "zzz"]
 # maximum number of warnings for users in star-shaped meetings 
 MAX_WARNINGS = 3
 
-TEST_MESSAGE = "test"
+# TCP keepalive settings for sockets of meeting hosts, 
+# so the kernel detects hosts that disappear without 
+# closing their connection. A dead peer is noticed after 
+# roughly IDLE + INTERVAL * COUNT seconds.
+KEEPALIVE_IDLE_SEC = 30
+KEEPALIVE_INTERVAL_SEC = 10
+KEEPALIVE_COUNT = 3
+
+# size (in bytes) of kernel send/receive buffers 
+# requested for server and p2p sockets
+SOCKET_BUFFER_SIZE = 256 * 1024
+
+# max number of pending connections queued by the kernel 
+# on listening sockets (capped by net.core.somaxconn)
+LISTEN_BACKLOG = 1024
+
+# max number of peer connections a joining 
+# mesh node opens at the same time 
+MAX_PARALLEL_CONNECTS = 32
+
+# max number of bytes read from a socket at once
+RECV_BUFFER_SIZE = 64 * 1024
+
+# max number of bytes buffered while waiting for the 
+# rest of a message. anything longer is discarded 
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+# max number of bytes waiting to be sent to a peer that 
+# is not reading. past this the connection is dropped 
+MAX_SEND_BUFFER_SIZE = 4 * 1024 * 1024
+
+# how often (in seconds) the shared ListenThread reactor 
+# checks for sockets closed by other threads
+LISTEN_TICK_SEC = 1.0
 
 MSG_DELIM = ";"
+MSG_DELIM_BYTES = MSG_DELIM.encode()
 
 
 
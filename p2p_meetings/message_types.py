@@ -1,7 +1,7 @@
 import json
-from socket import * 
 from p2p_meetings.constants import * 
 import logging 
+from types import SimpleNamespace
 from typing import Callable 
 
 ##########################################################
@@ -26,20 +26,47 @@ def decode_message(message_str:bytes, MessageType:Callable[[dict], "SocketMessag
     return MessageType(message_dict)
 
 
-REQUEST_FIELDS = [ "type", "data", "message" ]
+def encode_header(**fields):
+    """
+    JSON-encode the leading fields of a message that never 
+    change, leaving the object open (no closing brace) 
+    so the variable fields can be appended. 
+
+    Used to pre-encode constant parts of messages once 
+    at class definition time. 
+    """
+    return json.dumps(fields)[:-1].encode()
+
+
+def encode_with_data(header:bytes, data) -> bytes:
+    """
+    Finish a message started by encode_header by 
+    appending its data field. 
+    """
+    return b"".join([header, b', "data": ', json.dumps(data).encode(), 
+                     b"}", MSG_DELIM_BYTES])
+
+
+REQUEST_FIELDS = ( "type", "data", "message" )
 LIST = "list"
 JOIN = "join"
 CREATE = "create"
-REQUEST_TYPES = [LIST, JOIN, CREATE]
+REQUEST_TYPES = frozenset({LIST, JOIN, CREATE})
 STAR = "star"
 MESH = "mesh"
-MEETING_TYPES = [STAR, MESH]
+MEETING_TYPES = frozenset({STAR, MESH})
 
 # valid fields of application messages 
-DATA_FIELDS = [
+DATA_FIELDS = (
     "meetingType", "meetingID", 
     "hosts", "username", "host", "listen_p2p_port"
-]
+)
+
+# for a quick check that a nested dict has only data fields
+_DATA_FIELD_SET = frozenset(DATA_FIELDS)
+
+# marks a field that was never set
+_MISSING = object()
 
 class SocketMessage:
     """
@@ -56,22 +83,47 @@ class SocketMessage:
     r.b = 2
     """
 
-    def __init__(self, msg_dict, msg_fields):
-        self.msg_fields = msg_fields 
+    # valid top-level fields, set by each subclass. 
+    # kept on the class so instances don't carry a copy 
+    msg_fields = ()
+
+    def __init__(self, msg_dict):
+        msg_fields = self.msg_fields
         for key in msg_dict:
             # ignore unexpected fields 
             if key in msg_fields:
                 attr = msg_dict[key]
                 if type(attr) is dict:
-                    # recursively convert keys of dictionary to be attributes of 
-                    # the object itself 
-                    attr = SocketMessage(attr, DATA_FIELDS + msg_fields)
+                    # drop unexpected nested fields, so a peer 
+                    # can't set arbitrary attributes on data 
+                    if not attr.keys() <= _DATA_FIELD_SET:
+                        attr = self._known_nested_fields(attr)
+
+                    # give nested dictionaries (e.g., data) attribute 
+                    # access with a namespace. it is built in C and 
+                    # keeps the keys in a plain dict, so no field 
+                    # by field conversion is needed either way 
+                    attr = SimpleNamespace(**attr)
 
                 # assign dictionary key/value to 
                 # be attribute of this SocketMessage object
                 setattr(self, key, attr)
             else:
-                logging.error("Unexpected field for SocketMessage: %s", str(key))
+                logging.error("Unexpected field for SocketMessage: %s", key)
+
+    def _known_nested_fields(self, nested_dict:dict) -> dict:
+        """
+        Copy of a nested dictionary with only the 
+        fields a message may contain, logging the rest. 
+        """
+        known_fields = DATA_FIELDS + self.msg_fields
+        known = {}
+        for key, value in nested_dict.items():
+            if key in known_fields:
+                known[key] = value
+            else:
+                logging.error("Unexpected field for SocketMessage: %s", key)
+        return known
 
     def _get_dict(self):
         """
@@ -80,15 +132,16 @@ class SocketMessage:
         """
         d = {}
         for key in self.msg_fields:
-            if hasattr(self, key):
-                attr = self.__getattribute__(key)
+            attr = getattr(self, key, _MISSING)
+            if attr is _MISSING:
+                continue
                 
-                # convert nested SocketMessage objects 
-                # back to dictionaries
-                if isinstance(attr, SocketMessage):
-                    attr = attr._get_dict()
+            # convert nested namespaces back to 
+            # dictionaries (without copying)
+            if type(attr) is SimpleNamespace:
+                attr = attr.__dict__
 
-                d[key] = attr
+            d[key] = attr
         return d
 
     def encode(self):
@@ -97,8 +150,7 @@ class SocketMessage:
         then string, then bytes 
         for sending over a socket. 
         """
-        request_str = json.dumps(self._get_dict()) + MSG_DELIM
-        return request_str.encode()
+        return json.dumps(self._get_dict()).encode() + MSG_DELIM_BYTES
 
     def is_valid(self):
         """
@@ -116,11 +168,13 @@ class MeetingRequest(SocketMessage):
     May take the form of JOIN, CREATE, or LIST.
     """
 
+    msg_fields = REQUEST_FIELDS
+
     def __init__(self, request_dict={}):
         """
         Construct MeetingRequest object from dictionary.
         """
-        super().__init__(request_dict, REQUEST_FIELDS)
+        super().__init__(request_dict)
 
     def is_valid(self):
         """
@@ -157,6 +211,12 @@ class ListRequest(MeetingRequest):
     def __init__(self):
         super().__init__({ "type": LIST })
 
+    # list requests never change 
+    _ENCODED = encode_header(type=LIST) + b"}" + MSG_DELIM_BYTES
+
+    def encode(self):
+        return self._ENCODED
+
 class JoinRequest(MeetingRequest):
     def __init__(self, meeting_id, username):
         req_data = { "meetingID" : meeting_id , "username" : username}
@@ -164,18 +224,34 @@ class JoinRequest(MeetingRequest):
         req_dict = {"data": req_data, "type": req_type }
         super().__init__(req_dict)
 
+    _ENCODED_HEADER = encode_header(type=JOIN)
+
+    def encode(self):
+        return encode_with_data(self._ENCODED_HEADER, self.data.__dict__)
+
 class CreateMeshRequest(MeetingRequest):
     def __init__(self):
         data = { "meetingType" : MESH } 
         req_dict = {"type": CREATE, "data": data}
         super().__init__(req_dict)
 
+    # create requests never change 
+    _ENCODED = encode_with_data(encode_header(type=CREATE), {"meetingType": MESH})
+
+    def encode(self):
+        return self._ENCODED
+
 class CreateStarRequest(MeetingRequest):
     def __init__(self):
         data = { "meetingType" : STAR } 
         req_dict = {"type": CREATE, "data": data}
         super().__init__(req_dict)
 
+    _ENCODED = encode_with_data(encode_header(type=CREATE), {"meetingType": STAR})
+
+    def encode(self):
+        return self._ENCODED
+
 
 ##########################################################
 ##  wrap up response data in a class for abstraction    ##
@@ -183,7 +259,7 @@ class CreateStarRequest(MeetingRequest):
 ##  into ServerResponse object and vice versa.          ##
 ##########################################################
 
-RESPONSE_FIELDS = [ "type", "success", "message", "data" ]
+RESPONSE_FIELDS = ( "type", "success", "message", "data" )
 
 class ServerResponse(SocketMessage):
     """
@@ -202,11 +278,13 @@ class ServerResponse(SocketMessage):
       - why would this happen? 
     """
     
+    msg_fields = RESPONSE_FIELDS
+
     def __init__(self, request_dict={}):
         """
         Construct ServerResponse object from dictionary.
         """
-        super().__init__(request_dict, RESPONSE_FIELDS)
+        super().__init__(request_dict)
 
     def is_valid(self):
         """
@@ -240,17 +318,51 @@ class ServerResponse(SocketMessage):
 
 class ListResponse(ServerResponse):
     def __init__(self, meeting_id_list):
-        message = "\nMeetings found: %s\n" % len(meeting_id_list)
+        message = "\nMeetings found: %d\n" % len(meeting_id_list)
         resp_dict = {"message": message, 
                     "type": LIST,
                     "success": True,
                     "data": meeting_id_list }
         super().__init__(resp_dict) 
 
-class JoinStarSuccess(ServerResponse):
+    # type and success never change for list responses
+    _ENCODED_HEADER = encode_header(type=LIST, success=True)
+
+    def encode(self):
+        """
+        Only the message and meeting list vary, so 
+        append them to the pre-encoded header instead of 
+        rebuilding and encoding the whole dictionary. 
+        """
+        return b"".join([self._ENCODED_HEADER, 
+                         b', "message": ', json.dumps(self.message).encode(), 
+                         b', "data": ', json.dumps(self.data).encode(), 
+                         b"}", MSG_DELIM_BYTES])
+
+JOIN_SUCCESS_MESSAGE = "Join request successful! Preparing to join..."
+CREATE_SUCCESS_MESSAGE = "Create request successful! Creating new meeting..."
+
+class _SuccessResponse(ServerResponse):
+    """
+    Successful join or create response. Everything but 
+    data is the same for every response of a subclass 
+    (for both meeting types), so it is pre-encoded once 
+    in _ENCODED_HEADER. 
+    """
+    _ENCODED_HEADER = None
+
+    def encode(self):
+        return encode_with_data(self._ENCODED_HEADER, self.data.__dict__)
+
+class _JoinSuccess(_SuccessResponse):
+    _ENCODED_HEADER = encode_header(type=JOIN, success=True, message=JOIN_SUCCESS_MESSAGE)
+
+class _CreateSuccess(_SuccessResponse):
+    _ENCODED_HEADER = encode_header(type=CREATE, success=True, message=CREATE_SUCCESS_MESSAGE)
+
+class JoinStarSuccess(_JoinSuccess):
     def __init__(self, host_addr_port, username):
-        super().__init__()
-        message = "Join request successful! Preparing to join..."
+        message = JOIN_SUCCESS_MESSAGE
         data = { "host" : host_addr_port, "meetingType": STAR , "username" : username}
         resp_dict = {"message": message, 
                     "type": JOIN,
@@ -258,9 +370,9 @@ class JoinStarSuccess(ServerResponse):
                     "data": data }
         super().__init__(resp_dict) 
 
-class JoinMeshSuccess(ServerResponse):
+class JoinMeshSuccess(_JoinSuccess):
     def __init__(self, host_addr_port, username, listen_p2p_port):
-        message = "Join request successful! Preparing to join..."
+        message = JOIN_SUCCESS_MESSAGE
         data = { "host" : host_addr_port , "meetingType": MESH , "username" : username, "listen_p2p_port" : listen_p2p_port}
         resp_dict = {"message": message, 
                     "type": JOIN,
@@ -278,9 +390,18 @@ class JoinFailure(ServerResponse):
                     "data": None }
         super().__init__(resp_dict) 
 
-class CreateStarSuccess(ServerResponse):
+    # everything except the error message is constant
+    _ENCODED_HEADER = encode_header(type=JOIN, success=False)
+    _ENCODED_TRAILER = b', "data": null}' + MSG_DELIM_BYTES
+
+    def encode(self):
+        return b"".join([self._ENCODED_HEADER, 
+                         b', "message": ', json.dumps(self.message).encode(), 
+                         self._ENCODED_TRAILER])
+
+class CreateStarSuccess(_CreateSuccess):
     def __init__(self, meetingID, listen_p2p_port):
-        message = "Create request successful! Creating new meeting..."
+        message = CREATE_SUCCESS_MESSAGE
         data = { "meetingID" : meetingID , "meetingType" : STAR , 
                  "listen_p2p_port" : listen_p2p_port} 
         resp_dict = {"message": message, 
@@ -289,9 +410,9 @@ class CreateStarSuccess(ServerResponse):
                     "data": data }
         super().__init__(resp_dict) 
 
-class CreateMeshSuccess(ServerResponse):
+class CreateMeshSuccess(_CreateSuccess):
     def __init__(self, meetingID, listen_p2p_port):
-        message = "Create request successful! Creating new meeting..."
+        message = CREATE_SUCCESS_MESSAGE
         data = { "meetingID" : meetingID , "meetingType" : MESH , "listen_p2p_port" : listen_p2p_port } 
         resp_dict = {"message": message, 
                     "type": CREATE,
@@ -304,19 +425,21 @@ class CreateMeshSuccess(ServerResponse):
 
 # messages between nodes in p2p network (not client/server)
 
-P2P_MESSAGE_FIELDS = ["type", "message", "data"]
+P2P_MESSAGE_FIELDS = ("type", "message", "data")
 P2P_TEXT   = "p2p_text" # normal text message between nodes 
 P2P_REGISTER_USERNAME = "p2p_username"
 P2P_REGISTER_PORT= "p2p_register_port"
 P2P_MESH_CONNECT = "p2p_mesh_connect"
-P2P_MESSAGE_TYPES = [P2P_TEXT, P2P_REGISTER_USERNAME, P2P_MESH_CONNECT, P2P_REGISTER_PORT]
+P2P_MESSAGE_TYPES = frozenset({P2P_TEXT, P2P_REGISTER_USERNAME, P2P_MESH_CONNECT, P2P_REGISTER_PORT})
 
 class P2PMessage(SocketMessage):
+    msg_fields = P2P_MESSAGE_FIELDS
+
     def __init__(self, request_dict={}):
         """
         Construct P2PMessage object from dictionary.
         """
-        super().__init__(request_dict, P2P_MESSAGE_FIELDS)
+        super().__init__(request_dict)
 
         # initialize empty message
         if "message" not in request_dict:
@@ -331,8 +454,17 @@ class P2PText(P2PMessage):
     Regular (non-control) text message between two p2p nodes. 
     """
     def __init__(self, message_str):
-        msg_dict = {"message": message_str, "type": P2P_TEXT}
-        super().__init__(msg_dict)
+        # both fields are known, so set them directly 
+        # instead of building a dictionary to unpack 
+        self.type = P2P_TEXT
+        self.message = message_str
+
+    _ENCODED_HEADER = encode_header(type=P2P_TEXT)
+
+    def encode(self):
+        return b"".join([self._ENCODED_HEADER, 
+                         b', "message": ', json.dumps(self.message).encode(), 
+                         b"}", MSG_DELIM_BYTES])
 
     def is_valid(self):
         """
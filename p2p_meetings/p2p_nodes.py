@@ -1,10 +1,12 @@
 from socket import *
 import threading
 import logging
+import re
 from p2p_meetings.constants import * 
 from p2p_meetings.socket_util import * 
 from p2p_meetings.message_types import * 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # Author: Daniel Jeffries
 #
@@ -46,6 +48,12 @@ from collections import defaultdict
 #
 
 
+# matches any of the bad words, so a question is 
+# scanned once rather than once per word. 
+# with no bad words, use a pattern that never matches 
+BAD_WORDS_RE = re.compile("|".join(map(re.escape, BAD_WORDS)) or "(?!)")
+
+
 class PeerInfo:
     """
     PeerInfo keeps track of 
@@ -83,6 +91,10 @@ class HostNode(object):
         # and other peer info 
         self.peers = {}
 
+        # index username -> (addr,port) for direct messages 
+        # by username, kept in step with self.peers 
+        self.peers_by_username = {}
+
         # this is the port used for incoming traffic 
         # to this node 
         self.listen_p2p_port = listen_p2p_port
@@ -105,8 +117,12 @@ class HostNode(object):
         then send some test data when they connect.
         """
         self.accept_socket = make_socket()
+        # set buffer sizes before listening so 
+        # accepted peer sockets start with them 
+        tune_socket(self.accept_socket)
         self.accept_socket.bind(('', self.listen_p2p_port))
-        self.accept_socket.listen()
+        # queue bursts of peers joining at once 
+        self.accept_socket.listen(LISTEN_BACKLOG)
 
         while self.keep_alive:
             # addr_port is address and port 
@@ -119,15 +135,15 @@ class HostNode(object):
                 logging.error("Error acceptin socket: %s", str(e))
                 continue
 
-            # tell new peer our username
-            send_socket_message(connection_socket, RegisterUsername(self.username))
+            tune_socket(connection_socket)
 
+            # tell new peer our username and greet them 
+            # (sent together in one batch)
             welcome_message = P2PText(self.welcome_message())
-            send_socket_message(connection_socket, welcome_message)
+            send_socket_message(connection_socket, 
+                                [RegisterUsername(self.username), welcome_message])
 
             # host node adds new peer, no username established yet
-            # but use correct p2p port 
-            p2p_port = connection_socket.getpeername()
             self.add_new_peer(connection_socket, addr_port)
 
     def welcome_message(self):
@@ -152,6 +168,7 @@ class HostNode(object):
         # assign default username 
         self.peers[addr_port] = \
             PeerInfo(connection_socket, listen_thread, addr_port, username=username)
+        self.peers_by_username[username] = addr_port
         self.peers[addr_port].listen_thread.start()
 
 
@@ -191,10 +208,21 @@ class HostNode(object):
         Safely set username of a peer.
         """
         if addr_port in self.peers:
-            self.peers[addr_port].username = user_str
+            peer = self.peers[addr_port]
+            self._unindex_username(peer.username, addr_port)
+            peer.username = user_str
+            self.peers_by_username[user_str] = addr_port
         else:
             self.unknown_peer_error(addr_port, "for set_username")
     
+    def _unindex_username(self, username, addr_port):
+        """
+        Drop username from the index if it still 
+        refers to this peer. 
+        """
+        if self.peers_by_username.get(username) == addr_port:
+            del self.peers_by_username[username]
+
     def get_username(self, addr_port):
         """
         Safely get username by checking first if 
@@ -242,6 +270,7 @@ class HostNode(object):
             safe_shutdown_close(peer.conn_socket)
             # safely remove dict key 
             self.peers.pop(addr_port, None)
+            self._unindex_username(peer.username, addr_port)
         else:
             self.unknown_peer_error(addr_port, "for remove_user")
 
@@ -272,6 +301,7 @@ class HostNode(object):
             self.remove_user(addr_port)
 
         self.peers = {}
+        self.peers_by_username = {}
 
 
     def direct_message(self, addr_port, msg_str):
@@ -292,22 +322,30 @@ class HostNode(object):
         """
         Send a peer a message based on their unique username. 
         """
-        for addr_port in self.peers:
-            if self.peers[addr_port].username == username:
-                self.direct_message(addr_port, message_str)
-                break
-        # python for-else (else body executes if break never happens)
-        else:
+        addr_port = self.peers_by_username.get(username)
+        if addr_port is None:
             logging.error("Error: No peer with username '%s'", username)
+            return
+
+        self.direct_message(addr_port, message_str)
 
 
     def broadcast_message(self, msg_str):
         """
         Given a message as a string, send it to every peer. 
         """
-        for addr_port in self.peers:
-            # send message to a single peer
-            self.direct_message(addr_port, msg_str)
+        p2p_msg = P2PText(msg_str)
+        if not p2p_msg.is_valid():
+            logging.error("Invalid argument to P2PText: %s", str(msg_str))
+            return
+
+        # every peer gets the same bytes, so encode once 
+        msg_bytes = p2p_msg.encode()
+
+        # peers may connect or disconnect from other threads 
+        # while sending, so iterate over a snapshot 
+        for peer in list(self.peers.values()):
+            safe_send(peer.conn_socket, msg_bytes)
 
 
 
@@ -374,13 +412,15 @@ class MeshAudienceNode(HostNode):
         if not self.host_socket: # if connection failed
             return
 
-        # tell the host our preferred username 
-        send_socket_message(self.host_socket, RegisterUsername(username))
-        # tell the host our p2p socket (for other peers to establish 
-        # new connections). this calls host to call HostNode.set_p2p_port
-        send_socket_message(self.host_socket, RegisterPort(listen_p2p_port))
-        # send a welcome message for the host user to see we have connected
-        send_socket_message(self.host_socket, P2PText(self.welcome_message()))
+        # tell the host our preferred username and our p2p socket 
+        # (for other peers to establish new connections, this 
+        # calls host to call HostNode.set_p2p_port), and send a 
+        # welcome message for the host user to see we have connected. 
+        # all three are sent together in one batch 
+        send_socket_message(self.host_socket, 
+                            [RegisterUsername(username), 
+                             RegisterPort(listen_p2p_port), 
+                             P2PText(self.welcome_message())])
 
         # create new PeerInfo object for host and start listening 
         # to its socket 
@@ -404,7 +444,7 @@ class MeshAudienceNode(HostNode):
             # regular text from StarAudienceNode to HostNode
             # self.handle_question(addr_port, message_obj.message)
             peer_username = self.get_username(addr_port)
-            logging.info("%s says: %s", str(peer_username), str(message_obj.message))
+            logging.info("%s says: %s", peer_username, message_obj.message)
 
             # store message for debugging/testing 
             self.text_messages[peer_username] += message_obj.message
@@ -415,8 +455,9 @@ class MeshAudienceNode(HostNode):
 
         elif message_obj.type == P2P_MESH_CONNECT:
             # meeting host gives us list of (addr,port) pairs 
-            # so we can connect to the rest of the network
-            self.connect_to_mesh(message_obj.data.hosts)
+            # so we can connect to the rest of the network. 
+            # connecting blocks, so don't hold up the reactor 
+            threading.Thread(target=self.connect_to_mesh, args=(message_obj.data.hosts,)).start()
         else:
             logging.error("Unknown message type: %s", str(message_obj.type))
 
@@ -424,11 +465,20 @@ class MeshAudienceNode(HostNode):
     def connect_to_mesh(self, peer_addr_ports):
         """
         Make a connection request to every peer 
-        in the provided list 
+        in the provided list. The connections are independent, 
+        so they are made in parallel and joining takes about one 
+        round trip rather than one per peer. 
         """
-        for listen_p2p_port in peer_addr_ports:
-            logging.debug("Connecting to %s from %s", listen_p2p_port, self.listen_p2p_port)
-            conn_socket = connect_to_peer(listen_p2p_port)
+        if not peer_addr_ports:
+            return
+
+        logging.debug("Connecting to %s from %s", peer_addr_ports, self.listen_p2p_port)
+        n_workers = min(len(peer_addr_ports), MAX_PARALLEL_CONNECTS)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # map keeps results in the same order as peer_addr_ports
+            conn_sockets = list(executor.map(connect_to_peer, peer_addr_ports))
+
+        for listen_p2p_port, conn_socket in zip(peer_addr_ports, conn_sockets):
             self.conn_sockets.append(conn_socket)
             
             # add new peer object to self.peers and create a new
@@ -441,11 +491,11 @@ class MeshAudienceNode(HostNode):
 
                 self.add_new_peer(conn_socket, listen_p2p_port)
 
-                # also broadcast username to these peers
-                send_socket_message(conn_socket, RegisterUsername(self.username))
-
-                # send connection message
-                send_socket_message(conn_socket, P2PText(self.welcome_message()))
+                # also broadcast username to these peers 
+                # along with a connection message
+                send_socket_message(conn_socket, 
+                                    [RegisterUsername(self.username), 
+                                     P2PText(self.welcome_message())])
 
 
 class MeshHostNode(HostNode):
@@ -474,8 +524,12 @@ class MeshHostNode(HostNode):
         a list of peer ips. 
         """
         self.accept_socket = make_socket()
+        # set buffer sizes before listening so 
+        # accepted peer sockets start with them 
+        tune_socket(self.accept_socket)
         self.accept_socket.bind(('', self.listen_p2p_port))
-        self.accept_socket.listen()
+        # queue bursts of peers joining at once 
+        self.accept_socket.listen(LISTEN_BACKLOG)
 
         while self.keep_alive:
             try:
@@ -486,19 +540,21 @@ class MeshHostNode(HostNode):
                 logging.error("Exception accepting connections MeshHostNode: %s", str(e))
                 continue
 
-            # tell new peer our username
-            send_socket_message(connection_socket, RegisterUsername(HOST_USERNAME))
+            tune_socket(connection_socket)
 
+            # tell new peer our username and greet them 
+            # (sent together in one batch)
             welcome_message = P2PText(self.welcome_message())
-            send_socket_message(connection_socket, welcome_message)
+            send_socket_message(connection_socket, 
+                                [RegisterUsername(HOST_USERNAME), welcome_message])
 
             # send addresses of other peers when a new user connects,
             # so new user can connect to all of the peers in the list 
-            other_peer_addr_ports = []
-            for addr_prt in self.peers:
-                peer_obj = self.peers[addr_prt] 
-                if peer_obj.listen_p2p_port: # peer must have registered p2p port with host 
-                    other_peer_addr_ports.append((addr_prt[0], peer_obj.listen_p2p_port))
+            # (iterate over a snapshot, since peers may disconnect meanwhile)
+            other_peer_addr_ports = [(addr_prt[0], peer_obj.listen_p2p_port) 
+                                     for addr_prt, peer_obj in list(self.peers.items())
+                                     # peer must have registered p2p port with host 
+                                     if peer_obj.listen_p2p_port]
 
             # mesh host adds new peer to its network. here addr_port 
             # is the address/port for the tcp connection from the 
@@ -522,7 +578,7 @@ class MeshHostNode(HostNode):
             # regular text from StarAudienceNode to HostNode
             # self.handle_question(addr_port, message_obj.message)
             peer_username = self.get_username(addr_port)
-            logging.info("%s says: %s", str(peer_username), str(message_obj.message))
+            logging.info("%s says: %s", peer_username, message_obj.message)
 
             # store message for debugging/testing 
             self.text_messages[peer_username] += message_obj.message
@@ -604,7 +660,7 @@ class StarHostNode(HostNode):
 
         logging.info("New question from client %s: '%s'", self.get_username(addr_port), question_str)
 
-        if all([bw not in question_str for bw in BAD_WORDS]):
+        if BAD_WORDS_RE.search(question_str) is None:
             # broadcast message to entire meeting
             self.broadcast_message("Question from %s: '%s'" % (self.get_username(addr_port), question_str))
         else:
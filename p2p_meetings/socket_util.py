@@ -1,17 +1,29 @@
+import json
+import time
 import traceback
 import logging
 import threading
+import selectors
+import socket as socket_module
+from socket import * 
+from collections import deque
 from typing import Callable
 from p2p_meetings.constants import * 
 from p2p_meetings.message_types import * 
 
+# flag for a single non-blocking send. platforms without it 
+# (e.g., Windows) make the socket non-blocking instead 
+_SEND_NOWAIT = getattr(socket_module, "MSG_DONTWAIT", 0)
+
 
 def make_socket():
     """
-    Make TCP socket with timeout 
+    Make TCP socket with timeout. Nagle's algorithm is 
+    disabled since most messages are small and interactive. 
     """
     sock = socket(AF_INET, SOCK_STREAM)
     sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1) # FOR DEBUGGING
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
     # sock.settimeout(5)
     return sock
 
@@ -31,6 +43,37 @@ def safe_shutdown_close(socket):
     except:
         pass
 
+def tune_socket(conn_socket):
+    """
+    Disable Nagle's algorithm so small messages are sent 
+    immediately, and enlarge the kernel socket buffers. 
+    Set on a listening socket before bind() so that 
+    accepted sockets start with the same settings, and 
+    again on accepted sockets, since not every platform 
+    lets them inherit the options. 
+    """
+    try:
+        conn_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        conn_socket.setsockopt(SOL_SOCKET, SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        conn_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    except Exception as e:
+        logging.debug("Could not tune socket options: %s", str(e))
+
+def enable_keepalive(conn_socket):
+    """
+    Turn on TCP keepalive for a socket so that a peer 
+    that dies silently is eventually reported as an 
+    error on the socket.
+    """
+    try:
+        conn_socket.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        # fine-grained timers are only available on some platforms
+        conn_socket.setsockopt(IPPROTO_TCP, TCP_KEEPIDLE, KEEPALIVE_IDLE_SEC)
+        conn_socket.setsockopt(IPPROTO_TCP, TCP_KEEPINTVL, KEEPALIVE_INTERVAL_SEC)
+        conn_socket.setsockopt(IPPROTO_TCP, TCP_KEEPCNT, KEEPALIVE_COUNT)
+    except Exception as e:
+        logging.debug("Could not set keepalive options: %s", str(e))
+
 def connect_to_peer(addr_port):
     """
     Try to connect to host at addr_port 
@@ -55,10 +98,35 @@ def connect_to_peer(addr_port):
     
 
 def safe_send(conn_socket, msg_bytes):
-    try:
-        conn_socket.send(msg_bytes)
-    except Exception as e:
-        logging.error("Error occured while sending message over socket: %s", str(e))
+    """
+    Send bytes over a socket without blocking. Whatever 
+    doesn't fit in the kernel buffer is sent later by the 
+    shared listen reactor (see Reactor.send). 
+    """
+    get_listen_reactor().send(conn_socket, [msg_bytes])
+
+
+def safe_send_buffers(conn_socket, buffers):
+    """
+    Send several buffers with a single system call, 
+    so that related messages leave in as few segments
+    as possible. Like safe_send, this never blocks. 
+    """
+    get_listen_reactor().send(conn_socket, buffers)
+
+
+def send_nowait(conn_socket, buffers) -> int:
+    """
+    Try to send a list of buffers in one system call 
+    without blocking, and return the number of bytes sent. 
+    Uses scatter/gather sendmsg where available, 
+    otherwise joins the buffers. 
+    """
+    if len(buffers) == 1:
+        return conn_socket.send(buffers[0], _SEND_NOWAIT)
+    if hasattr(conn_socket, "sendmsg"):
+        return conn_socket.sendmsg(buffers, (), _SEND_NOWAIT)
+    return conn_socket.send(b"".join(buffers), _SEND_NOWAIT)
 
 
 def send_socket_message(conn_socket, msg_object):
@@ -67,20 +135,494 @@ def send_socket_message(conn_socket, msg_object):
     sends it over a socket. Perform a simple
     instance check to ensure msg_object is an instance
     of SocketMessage
+
+    msg_object may also be a list of SocketMessage objects, 
+    which are sent together in one batch. 
     """
     if isinstance(msg_object, SocketMessage):
         safe_send(conn_socket, msg_object.encode())
         return
 
+    if isinstance(msg_object, list) and \
+            all(isinstance(m, SocketMessage) for m in msg_object):
+        safe_send_buffers(conn_socket, [m.encode() for m in msg_object])
+        return
+
     logging.error("Error: Second argument is not instance of SocketMessage: %s", str(msg_object))
 
 
+class MessageBuffer:
+    """
+    TCP is a byte stream, so one recv may end in the middle
+    of a message. MessageBuffer keeps the incomplete tail
+    of a connection's stream until the rest of the message
+    (up to the special message delimiter) arrives. 
+    """
+    __slots__ = ("buffer",)
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add newly received bytes (bytes or memoryview) and return 
+        the bytes of every complete message received so far, 
+        or None if no message is complete yet. 
+        """
+        buffer = self.buffer
+
+        if not buffer and data[-1] == MSG_DELIM_BYTES[0]:
+            # common case: the read ended exactly on a message 
+            # boundary, so nothing needs to be copied
+            return data
+
+        buffer += data
+        # only the new bytes can contain a delimiter, since the 
+        # old tail had none. this keeps a long message arriving 
+        # in many pieces from being rescanned on every read 
+        end = buffer.rfind(MSG_DELIM_BYTES, len(buffer) - len(data)) + 1
+        if not end:
+            if len(buffer) > MAX_MESSAGE_SIZE:
+                logging.error("Discarding %d bytes without a message delimiter", len(buffer))
+                buffer.clear()
+            return None
+
+        # slicing copies once; deleting from the front of a 
+        # bytearray just moves its start, so the tail isn't copied
+        complete = buffer[:end]
+        del buffer[:end]
+        return complete
+
+
+def dispatch_messages(message_bytes, MessageType, handle_message):
+    """
+    Decode bytes received over a socket and pass each 
+    well-formed message to handle_message. 
+
+    The bytes may contain several messages, so they are
+    split on the special message delimiter. Messages 
+    should fit into some class given by MessageType 
+    (e.g., MeetingRequest or ServerResponse). 
+    """
+    message_str = ""
+    try:
+        # str() also accepts memoryviews, so no copy is needed
+        message_str = str(message_bytes, "utf-8")
+    except:
+        # message cant be decoded, just ignore it
+        return
+
+    # bind to locals once rather than looking 
+    # them up again for every message 
+    loads = json.loads
+    debug = logging.debug
+
+    # message may contain several requests, 
+    # so split it on the special request delimiter 
+    # character
+    for message_str in message_str.split(MSG_DELIM): 
+        if not message_str:  # ignore empty string
+            continue
+
+        # decode message using MessageType constructor and check if 
+        # it is a valid instance. decoding and validating share one 
+        # try block, since either failing means the message is dropped
+        try:
+            message_obj = MessageType(loads(message_str))
+            valid = message_obj.is_valid()
+        except Exception:
+            debug("Decoding failed for: '%s'", message_str)
+            continue
+
+        if not valid:
+            # let logging format the object only if debug is enabled
+            debug("Invalid message object: %s", message_obj)
+            continue
+
+        # process the message
+        try:
+            handle_message(message_obj)
+        except Exception as e:
+            debug("Failed to process message: %s", str(e))
+
+
+class Reactor:
+    """
+    Reactor multiplexes many sockets onto a single thread 
+    using the best selector available on the platform 
+    (epoll on Linux, kqueue on BSD). 
+
+    Each registered socket is paired with a callback, which 
+    is called from the reactor thread whenever the socket 
+    becomes readable. This replaces one thread per connection
+    with one thread for all connections. 
+
+    A socket closed by another thread silently drops out of 
+    epoll, so its callback would never run again. If tick_sec 
+    is given, the reactor calls the callback of any closed 
+    socket (about once per tick) so it can notice the error 
+    and clean up. 
+
+    The selector is not thread-safe, so it is only changed on 
+    the reactor thread. register and unregister may be called 
+    from any thread; changes from other threads are queued and 
+    applied once the reactor wakes up. 
+
+    Callbacks must not block, since every other socket waits 
+    for them. send queues whatever a socket can't take right 
+    away and writes it once the socket becomes writable. 
+    """
+
+    def __init__(self, tick_sec=None):
+        self.selector = selectors.DefaultSelector()
+        self.keep_alive = True
+
+        # if set, wake up at least this often to look for 
+        # sockets that were closed by another thread 
+        self.tick_sec = tick_sec
+        # monotonic time of the next check for closed sockets
+        self._next_reap = None
+
+        # (function, args) pairs queued by other threads 
+        # to run on the reactor thread 
+        self._pending = deque()
+        # ident of the thread running the loop, None until started
+        self._loop_ident = None
+
+        # map sockets to the bytes still waiting to be sent. 
+        # send may be called from any thread, so guard it with a lock
+        self._outbound = {}
+        self._outbound_lock = threading.Lock()
+
+        # callbacks run one at a time on the reactor thread, 
+        # so they can all recv_into this one buffer instead 
+        # of allocating new bytes for every read 
+        self.recv_buffer = memoryview(bytearray(RECV_BUFFER_SIZE))
+
+        # socket pair used to wake up the reactor when 
+        # it should notice a change (e.g., stop() was called)
+        self._wakeup_recv, self._wakeup_send = socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, self._drain_wakeup)
+
+        self.reactor_thread = threading.Thread(target=self.run)
+
+    def start(self):
+        """
+        Run the reactor loop in a separate thread. 
+        """
+        self.reactor_thread.start()
+        self._loop_ident = self.reactor_thread.ident
+
+    def _call_in_loop(self, fn, *args):
+        """
+        Run fn(*args) on the reactor thread. Before the reactor 
+        starts, or when already on the reactor thread, fn runs 
+        right away. Otherwise it is queued and the reactor is 
+        woken up to run it. 
+        """
+        if self._loop_ident is None or self._loop_ident == threading.get_ident():
+            fn(*args)
+            return
+
+        # deque appends are atomic, so no lock is needed
+        self._pending.append((fn, args))
+        self.wakeup()
+
+    def _run_pending(self):
+        """
+        Run everything queued by _call_in_loop, in order. 
+        """
+        pending = self._pending
+        while pending:
+            fn, args = pending.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error("Reactor callback failed: %s", str(e))
+
+    def register(self, conn_socket, on_readable):
+        """
+        Call on_readable (with no arguments) every time
+        conn_socket has data (or EOF) waiting to be read. 
+        """
+        self._call_in_loop(self._register, conn_socket, on_readable)
+
+    def _register(self, conn_socket, on_readable):
+        if conn_socket.fileno() == -1:
+            # closed before the reactor got to it
+            return
+
+        key = self._get_key(conn_socket)
+        if key is not None and key.fileobj is conn_socket:
+            # already watched while waiting to send
+            self.selector.modify(conn_socket, key.events | selectors.EVENT_READ, on_readable)
+            return
+
+        try:
+            self.selector.register(conn_socket, selectors.EVENT_READ, on_readable)
+        except KeyError:
+            # the file descriptor was reused after a socket was 
+            # closed, but before the reactor noticed 
+            self._reap_closed()
+            try:
+                self.selector.register(conn_socket, selectors.EVENT_READ, on_readable)
+            except Exception as e:
+                logging.error("Failed to register socket with reactor: %s", str(e))
+        except Exception as e:
+            logging.error("Failed to register socket with reactor: %s", str(e))
+
+    def unregister(self, conn_socket):
+        """
+        Stop watching conn_socket. Safe to call more than once.
+        """
+        self._call_in_loop(self._unregister, conn_socket)
+
+    def _unregister(self, conn_socket):
+        # the connection is being closed, so 
+        # drop anything that wasn't sent yet 
+        with self._outbound_lock:
+            self._outbound.pop(conn_socket, None)
+
+        try:
+            self.selector.unregister(conn_socket)
+        except Exception:
+            pass
+
+    def _get_key(self, conn_socket):
+        """
+        Return the selector key for conn_socket, 
+        or None if it isn't registered. 
+        """
+        try:
+            return self.selector.get_key(conn_socket)
+        except (KeyError, ValueError):
+            return None
+
+    def send(self, conn_socket, buffers):
+        """
+        Send a list of buffers over conn_socket without blocking. 
+        Bytes the kernel can't take right away are kept, in order, 
+        and written by the reactor once the socket is writable. 
+        Safe to call from any thread. 
+
+        A peer that stops reading can't stall the sender. Once 
+        more than MAX_SEND_BUFFER_SIZE bytes are waiting, the 
+        connection is shut down instead, and the reader of the 
+        socket sees it close and cleans up as usual. 
+        """
+        if not _SEND_NOWAIT:
+            conn_socket.setblocking(False)
+
+        watch = False
+        with self._outbound_lock:
+            pending = self._outbound.get(conn_socket)
+            if pending is None:
+                # nothing queued, so try to send right away
+                try:
+                    sent = send_nowait(conn_socket, buffers)
+                except BlockingIOError:
+                    sent = 0
+                except Exception as e:
+                    logging.error("Error occured while sending message over socket: %s", str(e))
+                    return
+
+                if sent == sum(map(len, buffers)):
+                    return
+
+                pending = bytearray(b"".join(buffers)[sent:])
+                self._outbound[conn_socket] = pending
+                watch = True
+            else:
+                for buffer in buffers:
+                    pending += buffer
+
+            overflow = len(pending) > MAX_SEND_BUFFER_SIZE
+            if overflow:
+                del self._outbound[conn_socket]
+
+        # outside the lock, since this runs right away 
+        # when called on the reactor thread
+        if watch and not overflow:
+            self._call_in_loop(self._watch_writable, conn_socket)
+
+        if overflow:
+            logging.error("Dropping connection with more than %d bytes waiting to be sent", 
+                            MAX_SEND_BUFFER_SIZE)
+            try:
+                conn_socket.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _watch_writable(self, conn_socket):
+        """
+        Wait for conn_socket to become writable 
+        so its queued bytes can be flushed. 
+        """
+        with self._outbound_lock:
+            if conn_socket not in self._outbound:
+                # already flushed or dropped 
+                return
+
+        key = self._get_key(conn_socket)
+        try:
+            if key is None:
+                # not read by this reactor, only written 
+                self.selector.register(conn_socket, selectors.EVENT_WRITE, None)
+            else:
+                self.selector.modify(conn_socket, key.events | selectors.EVENT_WRITE, key.data)
+        except Exception as e:
+            logging.error("Failed to watch socket for writing: %s", str(e))
+            with self._outbound_lock:
+                self._outbound.pop(conn_socket, None)
+
+    def _flush(self, conn_socket):
+        """
+        Called by the reactor when conn_socket is writable. 
+        Send as much of its queued bytes as the kernel takes, 
+        and stop watching for writes once everything is sent. 
+        """
+        with self._outbound_lock:
+            pending = self._outbound.get(conn_socket)
+            if pending is not None:
+                try:
+                    sent = conn_socket.send(pending, _SEND_NOWAIT)
+                except BlockingIOError:
+                    return
+                except Exception as e:
+                    logging.error("Error occured while sending message over socket: %s", str(e))
+                    # the connection is broken, drop the rest
+                    sent = len(pending)
+
+                del pending[:sent]
+                if pending:
+                    return
+                del self._outbound[conn_socket]
+
+        key = self._get_key(conn_socket)
+        if key is None:
+            return
+        if key.data is None:
+            self.selector.unregister(conn_socket)
+        else:
+            self.selector.modify(conn_socket, selectors.EVENT_READ, key.data)
+
+    def wakeup(self):
+        """
+        Interrupt a blocking select() call in the reactor thread.
+        """
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            # wakeup already pending (buffer full) or reactor closed
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            self._wakeup_recv.recv(1024)
+        except OSError:
+            pass
+
+    def _reap_closed(self):
+        """
+        Call the callback of every registered socket 
+        that has been closed (fileno() returns -1). 
+        """
+        for key in list(self.selector.get_map().values()):
+            if key.fileobj.fileno() != -1:
+                continue
+
+            try:
+                if key.data is not None:
+                    key.data()
+            except Exception as e:
+                logging.error("Reactor callback failed: %s", str(e))
+            # make sure a callback that didn't unregister 
+            # is not called again on the next tick
+            self._unregister(key.fileobj)
+
+    def run(self):
+        """
+        While keep_alive flag is set, wait for sockets 
+        to become readable and dispatch to their callbacks. 
+        """
+        # may be running on a thread other than reactor_thread
+        self._loop_ident = threading.get_ident()
+        if self.tick_sec is not None:
+            self._next_reap = time.monotonic() + self.tick_sec
+
+        while self.keep_alive:
+            try:
+                events = self.selector.select(self.tick_sec)
+            except Exception as e:
+                logging.error("Exception raised while selecting sockets: %s", str(e))
+                break
+
+            for key, mask in events:
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(key.fileobj)
+                    # data is None for sockets that are only written
+                    if mask & selectors.EVENT_READ and key.data is not None:
+                        key.data()
+                except Exception as e:
+                    logging.error("Reactor callback failed: %s", str(e))
+
+            self._run_pending()
+
+            # check for closed sockets once per tick, 
+            # not after every event
+            if self._next_reap is not None and time.monotonic() >= self._next_reap:
+                self._next_reap = time.monotonic() + self.tick_sec
+                try:
+                    self._reap_closed()
+                except Exception as e:
+                    logging.error("Reactor failed to reap closed sockets: %s", str(e))
+
+        self.selector.close()
+        safe_shutdown_close(self._wakeup_recv)
+        safe_shutdown_close(self._wakeup_send)
+
+    def stop(self):
+        """
+        Stop reactor loop by setting loop flag to False. 
+        """
+        self.keep_alive = False
+        self.wakeup()
+
+
+_listen_reactor = None
+_listen_reactor_lock = threading.Lock()
+
+def get_listen_reactor():
+    """
+    Return the reactor shared by every ListenThread, 
+    starting it the first time it is needed. 
+
+    The reactor thread is a daemon so that an idle 
+    reactor does not keep the program alive. 
+    """
+    global _listen_reactor
+
+    with _listen_reactor_lock:
+        if _listen_reactor is None:
+            _listen_reactor = Reactor(tick_sec=LISTEN_TICK_SEC)
+            _listen_reactor.reactor_thread.daemon = True
+            _listen_reactor.start()
+
+    return _listen_reactor
+
 
 class ListenThread:
     """
     ListenThread is an abstraction for the process of 
     looping continuously to listen and respond to messages on a socket.
 
+    Despite the name, a ListenThread no longer owns a thread. 
+    All of them share one reactor (see get_listen_reactor), 
+    which calls handle_ready whenever the socket is readable, 
+    so a node with many peers does not need a thread per peer. 
 
     A timer option (keep_alive_sec specifies the number of seconds on the timer, 
     or 0 for no limit) allows one to specify how long the connection should be 
@@ -98,40 +640,49 @@ class ListenThread:
         
         self.keep_alive = True
 
-        # optional timer for thread 
+        # holds a partially received message between reads
+        self.message_buffer = MessageBuffer()
+
+        # optional timer for connection. use a monotonic 
+        # clock so changes to the system time don't affect it 
         self.keep_alive_sec = keep_alive_sec
-        if keep_alive_sec:
-            self.start_time = int(time.time())
+        self.deadline = None
+        if keep_alive_sec > 0:
+            self.deadline = time.monotonic() + keep_alive_sec
 
-        self.listen_thread = threading.Thread(target=self.listen_and_do)
+        self.reactor = get_listen_reactor()
 
     def start(self):
         """
-        Start listening thread"
+        Start listening for messages on the shared reactor.
         """
-        self.listen_thread.start()
+        self.reactor.register(self.conn_socket, self.handle_ready)
 
     def stop(self):
         """
-        Stop thread by setting loop flag to False. 
+        Stop listening for messages. on_close is not called, 
+        since whoever stops the listener is already cleaning up.
         """
         self.keep_alive = False
+        self.reactor.unregister(self.conn_socket)
 
     def time_exceeded(self):
         """
         If timer being used, check time limit.
         If time is up, close the connection.
         """
-        if self.keep_alive_sec <= 0:
-            return False
+        return self.deadline is not None and time.monotonic() > self.deadline
 
-        cur_secs = int(time.time())
-        return cur_secs - self.start_time > self.keep_alive_sec
+    def finish(self):
+        """
+        Stop listening and perform the on_close cleanup function.
+        """
+        self.stop()
+        self.on_close()
 
-    def listen_and_do(self):
+    def handle_ready(self):
         """
-        While keep_alive flag is set, 
-        listen for messages on a socket. 
+        Called by the reactor when the socket is readable. 
 
         If socket is closed, on_close function is performed.
 
@@ -144,64 +695,35 @@ class ListenThread:
         Well-formed messages get processed by 
         handle_message function.
         """
-        while self.keep_alive:
-            message_bytes = bytearray()
-            try:
-                message_bytes = self.conn_socket.recv(1024)
-            except Exception as e:
-                logging.error("Exception raised while listening to socket: %s", str(e))
-                self.on_close()
-                return
-
-            # check time limit
-            if self.time_exceeded():
-                break
-
-            if not message_bytes:
-                # perform cleanup function 
-                logging.debug("ListenThread socket closed (empty bytes) from recv()") 
-                self.on_close()
-                return
-            
-            message_str = ""
-            try:
-                message_str = message_bytes.decode()
-            except:
-                # message cant be decoded, just ignore it
-                continue
-
-            # message may contain several requests, 
-            # so split it on the special request delimiter 
-            # character
-            message_strs = message_str.split(MSG_DELIM)
-
-            for message_str in message_strs: 
-                if not message_str:  # ignore empty string
-                    continue
-
-                # decode message using MessageType constructor and check if 
-                # it is a valid instance
-                logging.debug("Decoding message with class %s", str(self.MessageType))
-                message_obj = decode_message(message_str, self.MessageType)
-
-                if message_obj is None or not message_obj.is_valid():
-                    logging.debug("Invalid message object: %s", str(message_obj))
-                else:
-                    # process the message
-                    try:
-                        self.handle_message(message_obj)
-                    except Exception as e:
-                        logging.debug("Failed to process message: %s", str(e))
+        if not self.keep_alive:
+            return
+
+        # handle_ready only runs on the reactor thread, 
+        # so the reactor's buffer can be reused for every read
+        recv_buffer = self.reactor.recv_buffer
+        try:
+            nbytes = self.conn_socket.recv_into(recv_buffer)
+        except BlockingIOError:
+            # socket was made non-blocking by Reactor.send 
+            # and nothing is left to read 
+            return
+        except Exception as e:
+            logging.error("Exception raised while listening to socket: %s", str(e))
+            self.finish()
+            return
+
+        # check time limit
+        if self.time_exceeded():
+            safe_shutdown_close(self.conn_socket)
+            self.finish()
+            return
+
+        if nbytes == 0:
+            # perform cleanup function 
+            logging.debug("ListenThread socket closed (empty bytes) from recv()") 
+            self.finish()
+            return
         
-        # if while loop exited, perform cleanup function
-        # and close socket
-        safe_shutdown_close(self.conn_socket)
-
-        self.on_close()
-
-
-
-
-
-
-
+        message_bytes = self.message_buffer.feed(recv_buffer[:nbytes])
+        if message_bytes:
+            dispatch_messages(message_bytes, self.MessageType, self.handle_message)
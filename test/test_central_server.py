@@ -157,7 +157,10 @@ class LocalServerTest(P2PTestCase):
         self.assertIsNotNone(client_socket)
 
         sleep_until(condition)
-        ss_client_socket = self.server.client_sockets[-1]
+        # find the server side of the new connection 
+        client_addr = client_socket.getsockname()
+        ss_client_socket = next(sock for sock in self.server.client_sockets 
+                                    if sock.getpeername() == client_addr)
 
         # try sending response from server to client 
         self.server.send_response(response, ss_client_socket)
@@ -190,8 +193,8 @@ class LocalServerTest(P2PTestCase):
         # test (below) that server gets client port/IP correct
 
         # access meeting entry using most recently generated meetingID. 
-        # this works because dicts are ordered as of pythone 3.6
-        most_recent_id = list(self.server.meetings.keys())[-1]
+        # meeting IDs are increasing, so this is the largest key
+        most_recent_id = max(self.server.meetings.keys())
         meeting_entry = self.server.meetings[most_recent_id]
         # get server-side client socket 
         ss_client_socket = meeting_entry.client_socket
@@ -202,6 +205,25 @@ class LocalServerTest(P2PTestCase):
 
         return most_recent_id
 
+    def test_host_disconnect_deletes_meetings(self):
+        """Test that every meeting created by a client is 
+        deleted when that client disconnects"""
+        client_socket = self.make_client()
+        self.assertIsNotNone(client_socket)
+
+        prev_num_meetings = len(self.server.meetings)
+        condition = lambda: len(self.server.meetings) == prev_num_meetings + 2
+
+        client_socket.send(CreateStarRequest().encode() + CreateMeshRequest().encode())
+        sleep_until(condition)
+        self.assertTrue(condition())
+
+        # disconnect, so both meetings end
+        safe_shutdown_close(client_socket)
+        condition = lambda: len(self.server.meetings) == prev_num_meetings
+        sleep_until(condition)
+        self.assertTrue(condition())
+
     def test_handle_request_list(self):
         """Test that list request generates correct response"""
         response_dict = self.make_request_get_response(ListRequest())
@@ -210,6 +232,26 @@ class LocalServerTest(P2PTestCase):
         self.assertEqual(response_dict["type"], LIST)
         self.assertTrue(isinstance(response_dict["data"], list))
 
+    def test_slow_reader_does_not_stall_server(self):
+        """Test that a client that never reads its responses 
+        doesn't keep the server from answering other clients"""
+        stalled_socket = socket(AF_INET, SOCK_STREAM)
+        # small receive window, so responses back up quickly
+        stalled_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, 4096)
+        stalled_socket.connect((SERVER_IP, SERVER_PORT))
+        LocalServerTest.client_sockets.append(stalled_socket)
+
+        # keep asking for the listing without reading any of it 
+        stalled_socket.settimeout(1)
+        try:
+            stalled_socket.sendall(ListRequest().encode() * 100000)
+        except OSError:
+            # send buffer filled up, or the server dropped the client
+            pass
+
+        response_dict = self.make_request_get_response(ListRequest())
+        self.assertEqual(response_dict["type"], LIST)
+
     def test_handle_request_join(self):
         """Test that join request generates correct response"""
 
@@ -225,3 +267,61 @@ class LocalServerTest(P2PTestCase):
         self.assertTrue(isinstance(response_dict["data"], dict))
         self.assertTrue(response_dict["success"])
 
+
+    def test_handle_request_join_reserved_username(self):
+        """Test that joining with a reserved username fails"""
+        room_id = self._test_handle_request_create(CreateStarRequest())
+
+        for username in [HOST_USERNAME, DEFAULT_USERNAME]:
+            response_dict = self.make_request_get_response(JoinRequest(room_id, username))
+
+            self.assertEqual(response_dict["type"], JOIN)
+            self.assertFalse(response_dict["success"])
+
+class ShardedDictTest(TestCase):
+
+    def test_put_get_pop(self):
+        """Test basic operations on ShardedDict"""
+        d = ShardedDict(n=4)
+        for i in range(10):
+            d.put(i, str(i))
+
+        self.assertEqual(len(d), 10)
+        self.assertTrue(3 in d)
+        self.assertEqual(d[3], "3")
+        self.assertEqual(d.get(42, "missing"), "missing")
+
+        self.assertEqual(d.pop(3), "3")
+        self.assertIsNone(d.pop(3))
+        self.assertFalse(3 in d)
+        self.assertEqual(sorted(d.keys()), [0, 1, 2, 4, 5, 6, 7, 8, 9])
+
+
+class MeetingListingTest(TestCase):
+
+    def test_add_remove(self):
+        """Test that removed meetings leave the listing, including after compaction"""
+        listing = MeetingListing()
+        for meetingID in range(10):
+            listing.add(meetingID, STAR if meetingID % 2 else MESH)
+
+        for meetingID in range(7):
+            listing.remove(meetingID)
+        # removing an unknown meeting is a no-op 
+        listing.remove(100)
+
+        self.assertEqual(listing.snapshot(), [(7, STAR), (8, MESH), (9, STAR)])
+
+        listing.add(10, MESH)
+        listing.remove(8)
+        self.assertEqual(listing.snapshot(), [(7, STAR), (9, STAR), (10, MESH)])
+
+    def test_encoded_response(self):
+        """Test that the cached LIST response follows adds and removes"""
+        listing = MeetingListing()
+        listing.add(1, STAR)
+        self.assertEqual(listing.encoded_response(), ListResponse([(1, STAR)]).encode())
+
+        listing.add(2, MESH)
+        listing.remove(1)
+        self.assertEqual(listing.encoded_response(), ListResponse([(2, MESH)]).encode())
@@ -4,6 +4,7 @@ from test.test_central_server import P2PTestCase
 from test.test_util import sleep_until
 from p2p_meetings.client import Client
 from p2p_meetings.message_types import STAR, MESH
+from p2p_meetings.constants import DEFAULT_USERNAME
 
 
 class ClientTest(P2PTestCase):
@@ -166,6 +167,33 @@ class ClientTest(P2PTestCase):
         self.wait_for_node(host)
         self.assert_peer_connection(host, c)
 
+    def test_shutdown_during_join(self):
+        """
+        Test that shutting down while the p2p node is 
+        still being created closes the node as well. 
+        """
+        host = self.make_p2p_client()
+        host.star_create()
+
+        # shut down by the test itself
+        c = Client()
+        n = len(c.meeting_response_data)
+        condition = lambda: len(c.meeting_response_data) == n+1
+
+        c.list()
+        self._test_until(condition)
+        # newest star meeting, i.e., the host's
+        mid = [m for m, mtype in c.meeting_response_data[-1] if mtype == STAR][-1]
+
+        c.join(mid, "test user")
+        # shut down as soon as the join is accepted
+        sleep_until(lambda: c._join_thread is not None, interval=0)
+        c.shutdown()
+
+        self.assertFalse(c._join_thread.is_alive())
+        self.assertIsNotNone(c.node)
+        self.assertEqual(c.node.host_socket.fileno(), -1)
+
     def assert_peer_connection(self, host, client):
         """
         Test whether host and client 
@@ -176,9 +204,16 @@ class ClientTest(P2PTestCase):
         cp_addr = client_peer_sock.getsockname()
 
         # get address on host side and 
-        # make sure it matches with client 
-        self.assertTrue(cp_addr in host.node.peers)
+        # make sure it matches with client. the host 
+        # accepts in its own thread, so it may register 
+        # the peer slightly after the client is connected 
+        self._test_until(lambda: cp_addr in host.node.peers)
         peer_info = host.node.peers[cp_addr]
         host_peer_addr = peer_info.conn_socket.getpeername()
         self.assertEqual(host_peer_addr, cp_addr)
 
+        # once the client registers its username, 
+        # host can look up the peer by name 
+        self._test_until(lambda: peer_info.username != DEFAULT_USERNAME)
+        self.assertEqual(host.node.peers_by_username[peer_info.username], cp_addr)
+
@@ -1,5 +1,8 @@
+import json
 from unittest import TestCase
 from p2p_meetings.message_types import *
+from p2p_meetings.constants import *
+from p2p_meetings.socket_util import MessageBuffer
 
 class MessageTypesTest(TestCase):
     """
@@ -104,4 +107,50 @@ class MessageTypesTest(TestCase):
 
         # test that decoded SocketMessage object is valid 
         self.assertTrue(mtg_req_obj.is_valid())
-        
+
+    def test_unexpected_data_field(self):
+        """
+        Test that unknown fields nested in data are dropped. 
+        """
+        msg_str = json.dumps({"type": JOIN, "message": "", 
+                              "data": {"meetingID": 1, "username": "a", "__class__": 2}})
+        mtg_req_obj = decode_message(msg_str, MeetingRequest)
+
+        self.assertEqual(mtg_req_obj.data.meetingID, 1)
+        self.assertEqual(vars(mtg_req_obj.data), {"meetingID": 1, "username": "a"})
+
+    def test_specialized_encode(self):
+        """
+        Test that messages with a hand-written encode method
+        produce the same JSON as the generic SocketMessage.encode.
+        """
+        for msg_obj in self.message_objs:
+            generic = SocketMessage.encode(msg_obj).split(MSG_DELIM_BYTES)[0]
+            specialized = msg_obj.encode().split(MSG_DELIM_BYTES)[0]
+            self.assertEqual(json.loads(specialized), json.loads(generic))
+
+
+class MessageBufferTest(TestCase):
+    """
+    Test that MessageBuffer reassembles messages 
+    split across several reads. 
+    """
+
+    def test_split_message(self):
+        buf = MessageBuffer()
+        data = P2PText("first").encode() + P2PText("second").encode()
+
+        # first read ends in the middle of the second message 
+        cut = len(data) - 5
+        complete = buf.feed(memoryview(data)[:cut])
+        self.assertEqual(bytes(complete), P2PText("first").encode())
+
+        # rest of the second message arrives 
+        complete = buf.feed(memoryview(data)[cut:])
+        self.assertEqual(bytes(complete), P2PText("second").encode())
+
+    def test_no_complete_message(self):
+        buf = MessageBuffer()
+        data = P2PText("first").encode()
+        self.assertIsNone(buf.feed(data[:-1]))
+        self.assertEqual(buf.feed(data[-1:]), data)
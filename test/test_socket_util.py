@@ -0,0 +1,119 @@
+import sys
+import time
+import threading
+from socket import socketpair
+from unittest import TestCase
+from p2p_meetings.socket_util import Reactor
+from p2p_meetings.constants import MAX_SEND_BUFFER_SIZE
+from test.test_util import sleep_until
+
+
+class ReactorTest(TestCase):
+    """
+    Test that a Reactor keeps running while other
+    threads register and unregister sockets.
+    """
+
+    def setUp(self):
+        # tick often, so closed sockets are looked for constantly
+        self.reactor = Reactor(tick_sec=0.0001)
+        self.reactor.start()
+        # switch threads often so races show up quickly
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+        self.reactor.stop()
+        self.reactor.reactor_thread.join()
+
+    def close_all(self, socket_pairs):
+        # cleanups run after tearDown, once 
+        # the reactor is done with the sockets 
+        for a, b in socket_pairs:
+            a.close()
+            b.close()
+
+    def test_register_from_other_threads(self):
+        # a larger selector map makes each check take longer
+        idle = [socketpair() for _ in range(500)]
+        self.addCleanup(self.close_all, idle)
+        for a, _ in idle:
+            self.reactor.register(a, lambda: None)
+
+        stop = threading.Event()
+        def churn():
+            while not stop.is_set():
+                a, b = socketpair()
+                self.reactor.register(a, lambda: None)
+                self.reactor.unregister(a)
+                a.close()
+                b.close()
+
+        churn_threads = [threading.Thread(target=churn) for _ in range(4)]
+        for t in churn_threads:
+            t.start()
+        time.sleep(1)
+        stop.set()
+        for t in churn_threads:
+            t.join()
+
+        self.assertTrue(self.reactor.reactor_thread.is_alive())
+
+        # the reactor still dispatches new sockets
+        received = []
+        recv_sock, send_sock = socketpair()
+        self.addCleanup(self.close_all, [(recv_sock, send_sock)])
+        self.reactor.register(recv_sock, lambda: received.append(recv_sock.recv(1024)))
+        send_sock.send(b"hello")
+        sleep_until(lambda: received)
+        self.assertEqual(received, [b"hello"])
+
+    def test_send_does_not_block(self):
+        # far more than the kernel will buffer for a peer that isn't reading
+        data = bytes(range(256)) * 4096
+        recv_sock, send_sock = socketpair()
+        self.addCleanup(self.close_all, [(recv_sock, send_sock)])
+
+        self.reactor.send(send_sock, [data])
+
+        # the rest is flushed in order once the peer reads 
+        received = bytearray()
+        def read_all():
+            received.extend(recv_sock.recv(65536))
+            return len(received) == len(data)
+        sleep_until(read_all, interval=0)
+        self.assertEqual(bytes(received), data)
+
+    def test_send_overflow_drops_connection(self):
+        recv_sock, send_sock = socketpair()
+        self.addCleanup(self.close_all, [(recv_sock, send_sock)])
+
+        chunk = bytes(1024 * 1024)
+        for _ in range(MAX_SEND_BUFFER_SIZE // len(chunk) + 2):
+            self.reactor.send(send_sock, [chunk])
+
+        # sending side was shut down
+        with self.assertRaises(OSError):
+            send_sock.send(b"x")
+
+    def test_send_from_reactor_thread(self):
+        # callbacks, e.g. the server answering a request, 
+        # send from the reactor thread itself
+        data = bytes(range(256)) * 4096
+        recv_sock, send_sock = socketpair()
+        trigger_recv, trigger_send = socketpair()
+        self.addCleanup(self.close_all, [(recv_sock, send_sock), (trigger_recv, trigger_send)])
+
+        def on_trigger():
+            trigger_recv.recv(1)
+            self.reactor.send(send_sock, [data])
+        self.reactor.register(trigger_recv, on_trigger)
+        trigger_send.send(b"x")
+
+        received = bytearray()
+        def read_all():
+            received.extend(recv_sock.recv(65536))
+            return len(received) == len(data)
+        sleep_until(read_all, interval=0)
+        self.assertEqual(bytes(received), data)